@@ -18,8 +18,9 @@ setup(name='collectd-statsd',
       description='collectd plugin to write to a statsd daemon',
       url='https://github.com/lyft/collectd-statsd',
       license='Apache License 2.0',
+      python_requires='>=3.4',
       packages=find_packages(),
       install_requires=[
-          'statsd',
+          'statsd>=3.1,<4',
       ],
       )
@@ -20,34 +20,52 @@ A collectd plugin to write metrics to statsd.
 ######################
 # Standard Libraries #
 ######################
-from __future__ import (absolute_import, division,
-                        print_function, unicode_literals)
-from builtins import (dict, int, open, filter, zip)
+import os
 
 #########################
 # Third Party Libraries #
 #########################
 import collectd
-import statsd
 
 ######################
 # Internal Libraries #
 ######################
+from statsd_writer.client import BatchingStatsClient
 
 
 DEFAULTS = {
     'host': 'localhost',
     'port': 8125,
     'prefix': None,
+    'maxudpsize': 512,
+    'sendbuffer': 0,
+    'verbose': False,
     'typesdb': '/usr/share/collectd/types.db'
 }
 
+# The types reported by the interface plugin, mapped to the name used for
+# them in the stats path (the type without its leading 'if_').
+INTERFACE_TYPES = {
+    'if_dropped': 'dropped',
+    'if_errors': 'errors',
+    'if_octets': 'octets',
+    'if_packets': 'packets',
+}
+
+# Parsed types databases, keyed on their path. Each entry also records the
+# modification time and size of the file when it was parsed.
+TYPES = {}
+
+# Stats paths already built by stats_path, keyed on the metric identifier.
+PATHS = {}
+MAX_PATHS = 4096
+
 
 def parse_sources(sources):
     """
     Given a string of data sources; the second field in a line from a
-    collectd types database, return a list of dictionaries describing those
-    data sources.
+    collectd types database, return a list of the names of those data
+    sources.
 
     The sources should be delimited by spaces and, optionally, a comma
     (",") right after each list-entry.
@@ -56,32 +74,61 @@ def parse_sources(sources):
     name, type, minimal and maximal values, delimited by colons (":"):
     ds-name:ds-type:min:max. ds-type may be either ABSOLUTE, COUNTER,
     DERIVE, or GAUGE. min and max define the range of valid values for data
-    stored for this data-source.
+    stored for this data-source. Only the name is used to build stats paths,
+    so the rest of the quadruple is discarded.
     """
-    fields = ('name', 'type', 'min', 'max')
     sources = sources.replace(',', ' ').split()
-    return [dict(zip(fields, source.split(':'))) for source in sources]
+    return [source.split(':', 1)[0] for source in sources]
 
 
 def parse_types(path):
     """
     Parse the file at PATH as a collectd types database, returning a
-    dictionary of type information.
+    dictionary mapping each data-set name to its data-source names.
 
     Each line consists of two fields delimited by spaces and/or horizontal
     tabs. The first field defines the name of the data- set, while the
     second field defines a list of data-source specifications
-    """
-    with open(path) as types_db:
-        # Split each line on the first run of whitespace. The first item of
-        # each split is the name of the data-set. The second field is the
-        # data-source specifications for that data set. We skip empty lines
-        # and lines that start with '#' - these are comments.
-        stripped = (line.strip() for line in types_db)
-        specs = [line.split(None, 1) for line in stripped
-                 if line and not line.startswith('#')]
 
-    return dict((name, parse_sources(sources)) for name, sources in specs)
+    The result is cached, and only parsed again if the file's modification
+    time or size changes.
+    """
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = TYPES.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    types = {}
+    # Read the file as bytes, in a single pass over the lines, and only
+    # decode the lines that aren't blank or comments.
+    with open(path, 'rb') as types_db:
+        for line in types_db:
+            # Skip empty lines and lines that start with '#' - these are
+            # comments.
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+
+            # Split the line on the first run of whitespace. The first item
+            # is the name of the data-set. The second field is the
+            # data-source specifications for that data set.
+            name, sources = line.split(None, 1)
+            types[name.decode('utf-8')] = parse_sources(
+                sources.decode('utf-8'))
+
+    TYPES[path] = (stamp, types)
+    return types
+
+
+def path_suffixes(types):
+    """
+    Given a dictionary of type information, as returned by parse_types,
+    return a dictionary mapping each data-set name to the suffixes appended
+    to the stats path of each of its data sources.
+    """
+    return dict((name, ['.' + source for source in sources])
+                for name, sources in types.items())
 
 
 def configure(config, data=None):
@@ -120,7 +167,10 @@ def configure(config, data=None):
         # We've sanity-checked, so now we can use the value
         data['conf'][key] = item.values[0]
 
-    data['types'] = parse_types(data['conf'].pop('typesdb'))
+    # The data-source names never change, so build the path suffix for each
+    # of them now instead of joining it onto the path for every value.
+    types = parse_types(data['conf'].pop('typesdb'))
+    data['suffixes'] = path_suffixes(types)
     collectd.register_init(initialize, data=data)
 
 
@@ -129,97 +179,195 @@ def initialize(data=None):
     Create the statsd client object that will be used by the statsd_write
     function to send stats to statsd.
 
-    This object will be shared between collectd threads, but because we are
-    not using pipelines, the statsd object is thread safe.
+    This object will be shared between collectd threads. It only hands stats
+    off to its background thread: gauges are set in a dict, whose pending
+    values the thread takes with popitem(), and everything else is appended
+    to a deque. Both are atomic, so the shared statsd object is thread safe.
+    The pipelines write_apache_worker_memory uses belong to a single write,
+    and are never shared.
     """
-    data['stats'] = statsd.StatsClient(
+    data['stats'] = BatchingStatsClient(
         host=data['conf']['host'],
         port=int(data['conf']['port']),
-        prefix=data['conf']['prefix']
+        prefix=data['conf']['prefix'],
+        maxudpsize=int(data['conf']['maxudpsize']),
+        sendbuffer=int(data['conf']['sendbuffer'])
     )
     collectd.register_write(statsd_write, data=data)
+    collectd.register_shutdown(shutdown, data=data)
 
 
-def stats_path(values):
+def shutdown(data=None):
     """
-    Return the stats path for the given Values object.
+    Send any stats still queued by the statsd client before collectd exits.
     """
-    # The filter() call here will remove any None values, so when we join()
-    # these to get our stat path, only valid components will be joined.
-    return '.'.join(filter(None, [
-        # plugin name
+    data['stats'].close()
+
+
+def join_path(plugin, plugin_instance, type_, type_instance, suffix=None):
+    """
+    Join the components of a metric identifier, and an optional SUFFIX,
+    into a stats path.
+    """
+    # Only the plugin name is always present; each of the other components
+    # is only appended when it has a value.
+    path = plugin
+
+    # plugin instance, if any
+    if plugin_instance:
+        path += '.' + plugin_instance
+
+    # type, if any
+    if type_:
+        path += '.' + type_
+
+    # The name of the type instance
+    if type_instance:
+        path += '.' + type_instance
+
+    # Any extra component added by a custom writer
+    if suffix:
+        path += '.' + suffix
+
+    return path
+
+
+def stats_path(values, suffix=None, _getattr=getattr, _paths=PATHS):
+    """
+    Return the stats path for the given Values object, with SUFFIX appended
+    if one is given.
+
+    The _getattr and _paths arguments only bind the builtin and the path
+    cache to local names when the function is defined, which makes them
+    faster to look up on every call; they aren't meant to be passed.
+    """
+    # collectd reports the same, bounded set of metrics every interval, so
+    # remember the path built for each identifier rather than joining the
+    # same strings again every time. Every write of a metric then shares the
+    # one path string.
+    key = (
         values.plugin,
-        # plugin instance, if any
-        getattr(values, 'plugin_instance', None),
-        # type, if any
-        getattr(values, 'type', None),
-        # The name of the type instance
+        _getattr(values, 'plugin_instance', None),
+        _getattr(values, 'type', None),
         values.type_instance,
-    ]))
+        suffix,
+    )
+    path = _paths.get(key)
+    if path is None:
+        # Keep the cache bounded, in case the metric identifiers do change
+        # (short-lived processes or containers, for example).
+        if len(_paths) >= MAX_PATHS:
+            _paths.clear()
+        path = _paths[key] = join_path(*key)
+    return path
 
 
-def write_interface(values, types, client=None):
+def write_interface(values, suffixes, client=None, verbose=False):
     """
     Special handling for the interface plugin, because the path needs to
     include information from the type name.
     """
-    # Strip the leading if_ from the type and append it to the path.
-    path = '.'.join((stats_path(values), values.type[3:]))
-    return write_stats(values, types, base_path=path, client=client)
+    # Strip the leading if_ from the type and append it to the path. The
+    # known types are looked up, so only unexpected types need slicing.
+    suffix = INTERFACE_TYPES.get(values.type) or values.type[3:]
+    path = stats_path(values, suffix)
+    return write_stats(values, suffixes, base_path=path, client=client,
+                       verbose=verbose)
 
 
-def write_apache_worker_memory(values, types, client=None):
+def write_apache_worker_memory(values, suffixes, client=None,
+                               verbose=False):
     """
     Special handling for the apache_worker_memory plugin because we want to
     send timers instead of gauges.
     """
-    for idx, value in enumerate(values.values):
-        path = '.'.join((values.plugin, values.plugin_instance))
-
-        collectd.info('%s: %s = %s' % (values.plugin, path, value))
-
-        if client is not None:
-            # Intentionally *not* wrapped in a try/except so that an
-            # exception here causes collectd to slow down trying to write
-            # stats.
-            client.timing(path, value)
-        else:
-            # No statsd client, be noisy
-            message = 'Statsd client is None, not sending metrics!'
-            collectd.warning(message)
-            # Raise an exception so we aren't *too* noisy.
-            raise RuntimeError(message)
-
-
-def write_stats(values, types, base_path=None, client=None):
+    if client is None:
+        # No statsd client, be noisy
+        message = 'Statsd client is None, not sending metrics!'
+        collectd.warning(message)
+        # Raise an exception so we aren't *too* noisy.
+        raise RuntimeError(message)
+
+    # Every value is sent to the same path.
+    plugin = values.plugin
+    path = plugin + '.' + values.plugin_instance
+    info = collectd.info
+
+    # Intentionally *not* wrapped in a try/except, so that a stat the client
+    # can't send raises here and collectd logs it. The client sends from
+    # its background thread, so socket errors are dealt with there. The
+    # pipeline packs all of the values into as few UDP packets as possible.
+    with client.pipeline() as pipe:
+        timing = pipe.timing
+        for value in values.values:
+            if verbose:
+                info('%s: %s = %s' % (plugin, path, value))
+
+            timing(path, value)
+
+
+def write_stats(values, suffixes, base_path=None, client=None,
+                verbose=False):
     """
     Actually write the stats to statsd!
-    """
-    for idx, value in enumerate(values.values):
-        value = int(value)
-
-        if base_path is None:
-            base_path = stats_path(values)
 
-        # Append the data source name, if any
-        if len(values.values) > 1:
-            path = '.'.join((base_path, types[values.type][idx]['name']))
-        else:
-            path = base_path
-
-        collectd.info('%s: %s = %s' % (values.plugin, path, value))
-
-        if client is not None:
-            # Intentionally *not* wrapped in a try/except so that an
-            # exception here causes collectd to slow down trying to write
-            # stats.
-            client.gauge(path, value)
-        else:
-            # No statsd client, be noisy
-            message = 'Statsd client is None, not sending metrics!'
-            collectd.warning(message)
-            # Raise an exception so we aren't *too* noisy.
-            raise RuntimeError(message)
+    Each value written is also logged if VERBOSE is true.
+    """
+    if client is None:
+        # No statsd client, be noisy
+        message = 'Statsd client is None, not sending metrics!'
+        collectd.warning(message)
+        # Raise an exception so we aren't *too* noisy.
+        raise RuntimeError(message)
+
+    if base_path is None:
+        base_path = stats_path(values)
+
+    plugin = values.plugin
+    vals = values.values
+
+    # Most metrics only have a single value, whose path is just the base
+    # path, so send it straight away without going through the loop.
+    if len(vals) == 1:
+        value = int(vals[0])
+
+        if verbose:
+            collectd.info('%s: %s = %s' % (plugin, base_path, value))
+
+        # Intentionally *not* wrapped in a try/except, see below.
+        client.gauge(base_path, value)
+        return
+
+    # None of these change from one value to the next, so look them up
+    # once rather than on every pass through the loop. Each value's path
+    # has the name of its data source appended.
+    sources = suffixes[values.type]
+    info = collectd.info
+    # The gauges are set on the client itself rather than through a
+    # pipeline, so it can aggregate them; it packs them into as few UDP
+    # packets as possible when it sends them.
+    gauge = client.gauge
+
+    # Intentionally *not* wrapped in a try/except, so that a stat the client
+    # can't send raises here and collectd logs it. The client sends from
+    # its background thread, so socket errors are dealt with there. All of
+    # the values are converted up front with map(), rather than calling
+    # int() from Python on each pass through the loop.
+    for idx, value in enumerate(map(int, vals)):
+        path = base_path + sources[idx]
+
+        if verbose:
+            info('%s: %s = %s' % (plugin, path, value))
+
+        gauge(path, value)
+
+
+# Custom writer functions, keyed on the name of the plugin they handle.
+# Plugins without an entry here are written with write_stats.
+WRITERS = {
+    'apache_worker_memory': write_apache_worker_memory,
+    'interface': write_interface,
+}
 
 
 def get_stats_writer(plugin):
@@ -227,7 +375,7 @@ def get_stats_writer(plugin):
     Returns a writer function for the given plugin. If no custom writer
     function is defined, the default write_stats function is returned.
     """
-    return globals().get('write_%s' % plugin, write_stats)
+    return WRITERS.get(plugin, write_stats)
 
 
 def statsd_write(values, data=None):
@@ -235,8 +383,24 @@ def statsd_write(values, data=None):
     Entry point from collectd. Dispatches to a custom writer for the
     plugin, if one exists, or calls the default writer.
     """
-    writer = get_stats_writer(values.plugin)
-    return writer(values, data['types'], client=data['stats'])
+    client = data['stats']
+    verbose = data['conf']['verbose']
+
+    # This is called for every metric, so look the writer up directly
+    # rather than going through get_stats_writer.
+    writer = WRITERS.get(values.plugin)
+
+    # Fast path for the common case: a single gauge value for a plugin
+    # without a custom writer. This is exactly what write_stats would send,
+    # without the extra call and checks.
+    if (writer is None and not verbose and client is not None and
+            len(values.values) == 1):
+        client.gauge(stats_path(values), int(values.values[0]))
+        return
+
+    if writer is None:
+        writer = write_stats
+    return writer(values, data['suffixes'], client=client, verbose=verbose)
 
 
 collectd.register_config(configure)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright [2013, 2014, 2015] Lyft, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+A statsd client that sends stats from a background thread.
+"""
+######################
+# Standard Libraries #
+######################
+from collections import deque
+import socket
+import threading
+
+#########################
+# Third Party Libraries #
+#########################
+import collectd
+import statsd
+
+######################
+# Internal Libraries #
+######################
+
+
+class BatchingStatsClient(statsd.StatsClient):
+    """
+    A statsd client that queues stats and hands them off to a background
+    thread, which packs them into as few UDP packets as possible and sends
+    them.
+
+    The gauge(), timing() etc. methods only format and encode the stat and
+    append it to a queue, so collectd's write threads never wait on the
+    socket. Stats that can't be encoded still raise in the calling thread.
+    Appending to a deque is thread safe, so the client can be shared between
+    threads.
+
+    Gauges set to an absolute value are aggregated until they are sent: only
+    the latest value of each gauge matters, so setting the same gauge again
+    before the background thread gets to it replaces the pending value rather
+    than queueing another stat.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix=None,
+                 maxudpsize=512, sendbuffer=0):
+        super().__init__(
+            host=host, port=port, prefix=prefix, maxudpsize=maxudpsize)
+        # A larger socket send buffer lets the kernel absorb bursts of
+        # packets rather than dropping them. Zero keeps the OS default.
+        if sendbuffer:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                  sendbuffer)
+        # Connect the socket once, so each packet can be sent with send()
+        # rather than sendto() looking up the address every time.
+        self._sock.connect(self._addr)
+        self._stat_prefix = '%s.' % prefix if prefix else ''
+        self._queue = deque()
+        self._gauges = {}
+        self._queued = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='statsd-writer')
+        # Don't hold up collectd's exit if close() is never called.
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _prepare(self, stat, value, rate):
+        """
+        Format a stat for sending. Sampled stats are left to the base class,
+        but the common, unsampled case is formatted directly.
+        """
+        if rate < 1:
+            return super()._prepare(stat, value, rate)
+        return self._stat_prefix + stat + ':' + value
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        """
+        Set a gauge value. Absolute, unsampled values are held until the
+        background thread sends them, replacing any pending value.
+        """
+        if delta or rate < 1:
+            return super().gauge(stat, value, rate=rate, delta=delta)
+        # The gauge is only formatted by the background thread, so check
+        # now that its name can be sent, while we can still raise to the
+        # caller.
+        stat.encode('ascii')
+        self._gauges[stat] = value
+        self._queued.set()
+
+    def _send(self, data):
+        """
+        Queue DATA to be sent by the background thread.
+        """
+        # Encode the stat here rather than in the background thread, so a
+        # stat that can't be sent raises in the calling thread.
+        self._queue.append(data.encode('ascii'))
+        self._queued.set()
+
+    def _run(self):
+        """
+        Send queued stats until the client is closed.
+        """
+        while self._running:
+            self._queued.wait()
+            # Clear the event before draining, so anything queued while we
+            # send sets it again and is picked up on the next pass.
+            self._queued.clear()
+            self._flush()
+        # Send whatever was queued while we were being closed.
+        self._flush()
+
+    def _flush(self):
+        """
+        Send everything queued, reporting any error rather than letting it
+        kill the background thread.
+        """
+        try:
+            self._drain()
+        except Exception as error:
+            # Only the packet being built is lost. Anything still queued is
+            # sent on the next pass, which we make sure happens.
+            collectd.error('statsd_writer: failed to send stats: %r' % error)
+            self._queued.set()
+
+    def _drain(self):
+        """
+        Send everything in the queue, packing as many stats into each packet
+        as will fit in maxudpsize bytes.
+        """
+        # Queue the pending gauges first. popitem() is atomic, so gauges set
+        # while we are doing this are either queued now or left for the next
+        # pass. The base class gauge() formats them (including the reset
+        # needed for negative values) and queues them with _send().
+        gauges = self._gauges
+        while gauges:
+            stat, value = gauges.popitem()
+            super().gauge(stat, value)
+
+        queue = self._queue
+        data = None
+        while queue:
+            stat = queue.popleft()
+            if data is None:
+                data = stat
+            elif len(data) + len(stat) + 1 >= self._maxudpsize:
+                self._write(data)
+                data = stat
+            else:
+                data += b'\n' + stat
+        if data is not None:
+            self._write(data)
+
+    def _write(self, data):
+        """
+        Send DATA, already encoded, to statsd in a single packet.
+        """
+        try:
+            self._sock.send(data)
+        except socket.error:
+            # Like the base client, drop stats we can't send rather than
+            # letting the error kill the background thread.
+            pass
+
+    def close(self):
+        """
+        Stop the background thread, once it has sent everything queued, and
+        close the socket.
+        """
+        self._running = False
+        self._queued.set()
+        self._thread.join()
+        self._sock.close()
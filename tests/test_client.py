@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright [2013, 2014, 2015] Lyft, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Tests for the background-thread statsd client.
+"""
+######################
+# Standard Libraries #
+######################
+import socket
+import sys
+import types
+import unittest
+
+# The collectd module only exists inside collectd, so stand in for the parts
+# of it the plugin uses before importing it.
+collectd = types.ModuleType('collectd')
+collectd.errors = []
+collectd.error = collectd.errors.append
+collectd.warning = collectd.info = lambda message: None
+collectd.register_config = lambda callback, data=None: None
+sys.modules.setdefault('collectd', collectd)
+collectd = sys.modules['collectd']
+
+######################
+# Internal Libraries #
+######################
+from statsd_writer.client import BatchingStatsClient  # noqa: E402
+
+
+class BatchingStatsClientTest(unittest.TestCase):
+
+    def setUp(self):
+        # A statsd server on the loopback interface, to receive the packets.
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(2)
+        self.client = BatchingStatsClient(
+            host='127.0.0.1', port=self.server.getsockname()[1],
+            prefix='test')
+        del collectd.errors[:]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def receive(self):
+        return self.server.recv(65535).decode('ascii').split('\n')
+
+    def test_sends_stats(self):
+        self.client.gauge('cpu', 1)
+        self.assertEqual(self.receive(), ['test.cpu:1|g'])
+        self.client.timing('apache', 5)
+        self.assertEqual(self.receive(), ['test.apache:5|ms'])
+
+    def test_unencodable_stat_raises_in_caller(self):
+        self.assertRaises(UnicodeEncodeError,
+                          self.client.gauge, 'interface.caf\xe9', 1)
+        self.assertRaises(UnicodeEncodeError,
+                          self.client.timing, 'interface.caf\xe9', 1)
+
+        # Nothing was queued, and later stats are still sent.
+        self.client.gauge('cpu', 1)
+        self.assertEqual(self.receive(), ['test.cpu:1|g'])
+        self.assertTrue(self.client._thread.is_alive())
+
+    def test_error_in_background_thread_is_reported(self):
+        # A value the base class can't format only fails in the background
+        # thread, once the gauge is sent.
+        self.client.gauge('broken', 'not a number')
+        self.client.gauge('cpu', 1)
+
+        self.assertEqual(self.receive(), ['test.cpu:1|g'])
+        self.assertEqual(len(collectd.errors), 1)
+        self.assertIn('failed to send stats', collectd.errors[0])
+        self.assertTrue(self.client._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()